@@ -9,7 +9,10 @@
 
 import re
 import argparse
+import collections
+import concurrent.futures
 import glob
+import itertools
 import os
 import PIL.Image
 import numpy as np
@@ -19,6 +22,21 @@ import util
 
 import nibabel as nib
 
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 OUT_RESOLUTION = 256
 
 # Select z-slices from [25,124]
@@ -29,22 +47,95 @@ slice_max = 125
 train_basenames=['IXI002-Guys-0828', 'IXI012-HH-1211', 'IXI013-HH-1212', 'IXI014-HH-1236', 'IXI015-HH-1258', 'IXI016-Guys-0697', 'IXI017-Guys-0698', 'IXI019-Guys-0702', 'IXI020-Guys-0700', 'IXI021-Guys-0703', 'IXI022-Guys-0701', 'IXI023-Guys-0699', 'IXI024-Guys-0705', 'IXI025-Guys-0852', 'IXI026-Guys-0696', 'IXI027-Guys-0710', 'IXI028-Guys-1038', 'IXI029-Guys-0829', 'IXI030-Guys-0708', 'IXI031-Guys-0797', 'IXI033-HH-1259', 'IXI034-HH-1260', 'IXI035-IOP-0873', 'IXI036-Guys-0736', 'IXI037-Guys-0704', 'IXI038-Guys-0729', 'IXI039-HH-1261', 'IXI040-Guys-0724', 'IXI041-Guys-0706', 'IXI042-Guys-0725', 'IXI043-Guys-0714', 'IXI044-Guys-0712', 'IXI045-Guys-0713', 'IXI046-Guys-0824', 'IXI048-HH-1326', 'IXI049-HH-1358', 'IXI050-Guys-0711', 'IXI051-HH-1328', 'IXI052-HH-1343', 'IXI053-Guys-0727', 'IXI054-Guys-0707', 'IXI055-Guys-0730', 'IXI056-HH-1327', 'IXI057-HH-1342', 'IXI058-Guys-0726', 'IXI059-HH-1284', 'IXI060-Guys-0709', 'IXI061-Guys-0715', 'IXI062-Guys-0740', 'IXI063-Guys-0742']
 valid_basenames=['IXI064-Guys-0743', 'IXI065-Guys-0744', 'IXI066-Guys-0731', 'IXI067-HH-1356', 'IXI068-Guys-0756', 'IXI069-Guys-0769', 'IXI070-Guys-0767', 'IXI071-Guys-0770', 'IXI072-HH-2324', 'IXI073-Guys-0755']
 
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _fftshift2d_nb(x, s0, s1):
+        # Single-pass gather equivalent to the two np.concatenate calls below.
+        h, w = x.shape
+        out = np.empty_like(x)
+        for i in numba.prange(h):
+            src = (i + s0) % h
+            for j in range(w):
+                out[i, j] = x[src, (j + s1) % w]
+        return out
+
 def fftshift2d(x, ifft=False):
     assert (len(x.shape) == 2) and all([(s % 2 == 1) for s in x.shape])
     s0 = (x.shape[0] // 2) + (0 if ifft else 1)
     s1 = (x.shape[1] // 2) + (0 if ifft else 1)
+    if numba is not None:
+        return _fftshift2d_nb(x, s0, s1)
     x = np.concatenate([x[s0:, :], x[:s0, :]], axis=0)
     x = np.concatenate([x[:, s1:], x[:, :s1]], axis=1)
     return x
 
+# pyFFTW plans are expensive to create, so keep one forward/inverse pair per
+# array shape and reuse it for every slice (and volume) of that shape.
+# fftw_threads also sets the scipy.fft worker count when pyFFTW is missing.
+fftw_threads = os.cpu_count()
+fftw_planner_effort = 'FFTW_MEASURE'
+_fftw_plans = {}
+
+def setup_fftw(planner_effort, wisdom=None):
+    """ Select the pyFFTW planner effort and seed the planner with previously exported wisdom. """
+    global fftw_planner_effort
+    fftw_planner_effort = planner_effort
+    if pyfftw is not None and wisdom is not None:
+        pyfftw.import_wisdom(wisdom)
+
+def get_fftw_plans(shape):
+    """ Return cached (forward, inverse) pyFFTW plans operating in-place on shared complex64 buffers. """
+    shape = tuple(shape)
+    if shape not in _fftw_plans:
+        spatial = pyfftw.empty_aligned(shape, dtype='complex64')
+        spectrum = pyfftw.empty_aligned(shape, dtype='complex64')
+        fft = pyfftw.FFTW(spatial, spectrum, axes=(0, 1), direction='FFTW_FORWARD', flags=(fftw_planner_effort,), threads=fftw_threads)
+        ifft = pyfftw.FFTW(spectrum, spatial, axes=(0, 1), direction='FFTW_BACKWARD', flags=(fftw_planner_effort,), threads=fftw_threads)
+        _fftw_plans[shape] = (fft, ifft)
+    return _fftw_plans[shape]
+
+def apply_kspace_mask(slice, mask):
+    """ Return |IFFT2(FFT2(slice) * mask)| over the first two axes.
+
+    The transforms run in single precision (complex64) on every backend;
+    numpy.fft would otherwise promote the float32 slices to complex128.
+    """
+    if pyfftw is not None:
+        fft, ifft = get_fftw_plans(slice.shape)
+        fft.input_array[:] = slice
+        fft_slice = fft()
+        fft_slice *= mask
+        return np.abs(ifft())
+
+    if scipy_fft is not None:
+        fft_slice = scipy_fft.fft2(slice.astype(np.float32, copy=False), axes=(0, 1), workers=fftw_threads)
+        fft_slice *= mask
+        return np.abs(scipy_fft.ifft2(fft_slice, axes=(0, 1), overwrite_x=True, workers=fftw_threads))
+
+    fft_slice = np.fft.fft2(slice, axes=(0, 1)).astype(np.complex64, copy=False)
+    fft_slice *= mask
+    return np.abs(np.fft.ifft2(fft_slice, axes=(0, 1))).astype(np.float32, copy=False)
+
+# Undersampling masks are drawn from uint8 random bytes rather than float64
+# uniforms: 1 byte per k-space sample instead of 8, at 1/256 resolution of
+# mask_fraction.
+_mask_rng = np.random.default_rng()
+
+def random_kspace_mask(shape, mask_fraction=0.5):
+    """ Return a boolean mask keeping (approximately) mask_fraction of the samples at random. """
+    threshold = int(round(mask_fraction * 256))
+    return _mask_rng.integers(0, 256, size=shape, dtype=np.uint8) < threshold
+
 def undersample_kspace(slice, mask_fraction=0.5):
-    """ Apply random undersampling by masking out a fraction of k-space. """
-    fft_slice = np.fft.fft2(slice)
-    fft_slice = np.fft.fftshift(fft_slice)
-    mask = np.random.rand(*fft_slice.shape) < mask_fraction
-    undersampled_fft = fft_slice * mask
-    undersampled_fft = np.fft.ifftshift(undersampled_fft)
-    return np.abs(np.fft.ifft2(undersampled_fft))
+    """ Apply random undersampling by masking out a fraction of k-space.
+
+    Accepts a single [H, W] slice or a [H, W, N] stack of slices; the 2D FFT is
+    taken over the first two axes so a whole stack is transformed in one call.
+    """
+    # The mask is i.i.d. per frequency, so it can be applied to the unshifted
+    # spectrum directly; no fftshift/ifftshift round trip is needed.
+    return apply_kspace_mask(slice, random_kspace_mask(slice.shape, mask_fraction))
+
 def preprocess_mri(input_files,
                    output_file):
     all_files = sorted(input_files)
@@ -80,23 +171,156 @@ def preprocess_mri(input_files,
     util.save_pkl((img_primal, img_spectrum), output_file)
 
 
+def undersample_kspace_gpu(slice, mask_fraction=0.5):
+    """ Same as undersample_kspace but runs the FFT, masking and IFFT on a CUDA device (requires CuPy). """
+    import cupy as cp
+    # CuPy caches cuFFT plans per shape, so repeated volumes reuse them.
+    fft_slice = cp.fft.fft2(cp.asarray(slice, dtype=cp.float32), axes=(0, 1))
+    fft_slice *= cp.random.rand(*fft_slice.shape, dtype=cp.float32) < mask_fraction
+    return cp.asnumpy(cp.abs(cp.fft.ifft2(fft_slice, axes=(0, 1))))
+
+# Radial masks only depend on the slice shape and the number of spokes.
+_radial_masks = {}
+
+def radial_kspace_mask(shape, num_lines=30):
+    """ Return a boolean spoke mask in unshifted (np.fft.fft2) frequency order. """
+    key = (tuple(shape), num_lines)
+    if key not in _radial_masks:
+        mask = np.zeros(shape, dtype=bool)
+        center = np.array(mask.shape) // 2
+        angles = np.linspace(0, np.pi, num_lines, endpoint=False)
+        for angle in angles:
+            for r in range(center[0]):
+                x = int(center[0] + r * np.cos(angle))
+                y = int(center[1] + r * np.sin(angle))
+                if 0 <= x < mask.shape[0] and 0 <= y < mask.shape[1]:
+                    mask[x, y] = True
+                    mask[mask.shape[0] - x - 1, mask.shape[1] - y - 1] = True
+        # The spokes are laid out around the centered DC term; shift the mask
+        # once instead of shifting every spectrum back and forth.
+        _radial_masks[key] = np.fft.ifftshift(mask)
+    return _radial_masks[key]
+
 def radial_undersample_kspace(slice, num_lines=30):
-    """ Apply radial undersampling by simulating spoke-like sampling in k-space. """
-    fft_slice = np.fft.fft2(slice)
-    fft_slice = np.fft.fftshift(fft_slice)
-    mask = np.zeros_like(fft_slice, dtype=bool)
-    center = np.array(mask.shape) // 2
-    angles = np.linspace(0, np.pi, num_lines, endpoint=False)
-    for angle in angles:
-        for r in range(center[0]):
-            x = int(center[0] + r * np.cos(angle))
-            y = int(center[1] + r * np.sin(angle))
-            if 0 <= x < mask.shape[0] and 0 <= y < mask.shape[1]:
-                mask[x, y] = True
-                mask[mask.shape[0] - x - 1, mask.shape[1] - y - 1] = True
-    undersampled_fft = fft_slice * mask
-    undersampled_fft = np.fft.ifftshift(undersampled_fft)
-    return np.abs(np.fft.ifft2(undersampled_fft))
+    """ Apply radial undersampling by simulating spoke-like sampling in k-space.
+
+    Like undersample_kspace, accepts a single slice or an [H, W, N] stack.
+    """
+    mask = radial_kspace_mask(slice.shape[:2], num_lines)
+    return apply_kspace_mask(slice, mask.reshape(mask.shape + (1,) * (slice.ndim - 2)))
+
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True)
+    def _finalize_slice_nb(x, out, hb0, hb1):
+        # Clamp, scale and convert in one sweep, without NumPy temporaries.
+        # Serial on purpose: a single slice is too small to be worth a thread
+        # team, and genpng already runs one process per core.
+        h, w = x.shape
+        for i in range(h):
+            for j in range(w):
+                v = x[i, j]
+                v = 0.0 if v < 0.0 else (1.0 if v > 1.0 else v)
+                out[hb0 + i, hb1 + j] = np.uint8(v * 255.0)
+
+def finalize_slice(slice, output, hborder):
+    """ Clamp a slice to [0,1], scale to [0,255] and write it as uint8 into the interior of the padded output. """
+    hb0, hb1 = int(hborder[0]), int(hborder[1])
+    # The Numba kernel does not bounds check; a slice larger than the output
+    # (negative border) would otherwise write past the end of the buffer.
+    assert 0 <= hb0 and hb0 + slice.shape[0] <= output.shape[0], 'slice does not fit in output: %s' % str(slice.shape)
+    assert 0 <= hb1 and hb1 + slice.shape[1] <= output.shape[1], 'slice does not fit in output: %s' % str(slice.shape)
+    if numba is not None:
+        _finalize_slice_nb(slice, output, hb0, hb1)
+    else:
+        output[hb0 : hb0 + slice.shape[0], hb1 : hb1 + slice.shape[1]] = np.clip(slice, 0.0, 1.0) * 255.0
+
+def init_genpng_worker(planner_effort, wisdom):
+    """ Per-process setup for the genpng worker pool. """
+    global fftw_threads, _mask_rng
+    # Volumes already run in parallel across processes; keep FFTW single
+    # threaded in each of them to avoid oversubscribing the cores.
+    fftw_threads = 1
+    # Forked workers inherit the parent's RNG state; reseed so that each
+    # worker draws different undersampling masks.
+    _mask_rng = np.random.default_rng()
+    # Fresh worker processes would otherwise re-plan every FFT shape.
+    setup_fftw(planner_effort, wisdom)
+
+def load_volume(nii_file):
+    """ Load the selected z-slices of an IXI-T1 volume. Returns (volume shape, [H, W, N] float32 stack in [0,1]). """
+    print('Loading', nii_file)
+    nii_img = nib.load(nii_file)
+    # Read only the selected z-slices, converted straight to float32 by the
+    # array proxy, and normalize them to [0,1]
+    # np.array always copies: float32 files would otherwise come back as a
+    # read-only view that cannot be normalized in place.
+    stack = np.array(nii_img.dataobj[:, :, slice_min:slice_max], dtype=np.float32)
+    stack /= np.max(stack)
+    return nii_img.shape, stack
+
+def prefetch_volumes(nii_files, depth=2):
+    """ Yield (nii_file, load_volume(nii_file)) pairs while up to `depth` following volumes load in the background. """
+    # Decompression and dtype conversion release the GIL, so a single loader
+    # thread overlaps disk I/O with the FFT and PNG work of the main thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = collections.deque()
+        for nii_file in nii_files:
+            pending.append((nii_file, executor.submit(load_volume, nii_file)))
+            if len(pending) > depth:
+                loaded_file, future = pending.popleft()
+                yield loaded_file, future.result()
+        while pending:
+            loaded_file, future = pending.popleft()
+            yield loaded_file, future.result()
+
+def genpng_volume(nii_file, args, volume=None):
+    """ Convert the selected z-slices of one IXI-T1 volume into image files.
+
+    `volume` is the result of load_volume(nii_file) if it was loaded already.
+    """
+    shape, stack = load_volume(nii_file) if volume is None else volume
+    print('Processing', nii_file)
+    name = os.path.basename(nii_file).split(".")[0]
+    print("name", name)
+    hborder = (np.asarray([OUT_RESOLUTION, OUT_RESOLUTION]) - shape[0:2]) // 2
+    print("Img: ", shape, " border: ", hborder)
+    print('Max value', np.max(stack))
+    # Slices that never reach one output grey level would be written out all
+    # black and skipped anyway, so skip their clamp and save up front.  The
+    # FFT batch keeps the fixed [slice_min, slice_max) shape so that every
+    # volume of a given size reuses the same cached FFT plan.
+    slice_peaks = np.max(stack, axis=(0, 1))
+    # Undersample all selected z-slices at once with a batched 2D FFT
+    if args.undersample:
+        if args.radial:
+            stack = radial_undersample_kspace(stack)
+        elif args.gpu:
+            stack = undersample_kspace_gpu(stack)
+        else:
+            stack = undersample_kspace(stack)
+    # Pad to output resolution by inserting zeros.  The border is the same
+    # for every slice, so allocate once and only overwrite the interior.
+    output = np.zeros([OUT_RESOLUTION, OUT_RESOLUTION], dtype=np.uint8)
+    # # Slice along z dimension
+    #for s in range(70, nii_img.shape[2]-25):
+    for i, s in enumerate(range(slice_min, slice_max)):
+        if slice_peaks[i] <= 1.0 / 255.0:
+            continue
+        slice = stack[:, :, i]
+
+        finalize_slice(slice, output, hborder)
+
+        # Save to png (or raw .npy), skipping slices that came out all black
+        if output.any():
+            outname = os.path.join(args.outdir, "%s_%03d.%s" % (name, s, args.format))
+            if args.format == 'npy':
+                np.save(outname, output)
+            else:
+                # Fast zlib level: encoding at the default level 6 dominates genpng run time.
+                PIL.Image.fromarray(output).save(outname, optimize=False, compress_level=1)
+
+    # Hand this process' FFTW wisdom back so that genpng can persist it.
+    return pyfftw.export_wisdom() if pyfftw is not None else None
 
 def genpng(args):
     if args.outdir is None:
@@ -105,6 +329,15 @@ def genpng(args):
     if args.ixi_dir is None:
         print ('Must specify input IXI-T1 directory with --ixi-dir')
         sys.exit(1)
+    if args.gpu:
+        if not args.undersample or args.radial:
+            print ('--gpu only applies to random undersampling (--undersample without --radial)')
+            sys.exit(1)
+        try:
+            import cupy
+        except ImportError:
+            print ('--gpu requires CuPy to be installed')
+            sys.exit(1)
 
     mri_directory = args.ixi_dir
 
@@ -113,39 +346,32 @@ def genpng(args):
 
     nii_files = glob.glob(os.path.join(mri_directory, "*.nii.gz"))
 
-    for nii_file in nii_files:
-        print('Processing', nii_file) 
-        nii_img = nib.load(nii_file)
-        name = os.path.basename(nii_file).split(".")[0]
-        print("name", name)
-        hborder = (np.asarray([OUT_RESOLUTION, OUT_RESOLUTION]) - nii_img.shape[0:2]) // 2
-        print("Img: ", nii_img.shape, " border: ", hborder)
-        # Normalize image to [0,1]
-        img = nii_img.get_data().astype(np.float32)
-        img = img / np.max(img)
-        print('Max value', np.max(img))
-        # # Slice along z dimension
-        #for s in range(70, nii_img.shape[2]-25):
-        for s in range(slice_min, slice_max):
-            slice = img[:, :, s]
-            
-            if args.undersample:
-                if args.radial:
-                    slice = radial_undersample_kspace(slice)
-                else:
-                    slice = undersample_kspace(slice)
-            
-            # Pad to output resolution by inserting zeros
-            output = np.zeros([OUT_RESOLUTION, OUT_RESOLUTION])
-            output[hborder[0] : hborder[0] + nii_img.shape[0], hborder[1] : hborder[1] + nii_img.shape[1]] = slice
-            output = np.minimum(output, 1.0)
-            output = np.maximum(output, 0.0)
-            output = output * 255
-
-            # Save to png
-            if np.max(output) > 1.0:
-                outname = os.path.join(out_directory, "%s_%03d.png" % (name, s))
-                PIL.Image.fromarray(output).convert('L').save(outname)
+    # A single process keeps the GPU to itself when --gpu is given.
+    num_jobs = args.jobs or (1 if args.gpu else os.cpu_count())
+
+    # Reuse FFTW plans from earlier runs.  When wisdom is persisted the more
+    # thorough FFTW_PATIENT planner pays off, as it only runs once per shape.
+    use_wisdom = args.fftw_wisdom is not None and pyfftw is not None
+    wisdom = None
+    if use_wisdom and os.path.isfile(args.fftw_wisdom):
+        print('Loading FFTW wisdom from', args.fftw_wisdom)
+        wisdom = util.load_pkl(args.fftw_wisdom)
+    planner_effort = 'FFTW_PATIENT' if use_wisdom else 'FFTW_MEASURE'
+    setup_fftw(planner_effort, wisdom)
+
+    if num_jobs == 1:
+        for nii_file, volume in prefetch_volumes(nii_files):
+            genpng_volume(nii_file, args, volume)
+    else:
+        # Volumes are independent, so fan them out over a process pool.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_jobs, initializer=init_genpng_worker, initargs=(planner_effort, wisdom)) as executor:
+            for worker_wisdom in executor.map(genpng_volume, nii_files, itertools.repeat(args)):
+                if worker_wisdom is not None:
+                    pyfftw.import_wisdom(worker_wisdom)
+
+    if use_wisdom:
+        print('Saving FFTW wisdom to', args.fftw_wisdom)
+        util.save_pkl(pyfftw.export_wisdom(), args.fftw_wisdom)
 
 def make_slice_name(basename, slice_idx):
     return basename + ('-T1_%03d.png' % slice_idx)
@@ -201,6 +427,10 @@ def main():
     parser_genpng.add_argument('--outdir', help='Directory where to save .PNG files')
     parser_genpng.add_argument('--undersample', action='store_true', help='Apply k-space undersampling to slices')
     parser_genpng.add_argument('--radial', action='store_true', help='Use radial undersampling instead of random masking')
+    parser_genpng.add_argument('--gpu', action='store_true', help='Run random k-space undersampling on a CUDA device (requires CuPy)')
+    parser_genpng.add_argument('--jobs', type=int, default=None, help='Number of volumes to process in parallel (default: number of CPUs, or 1 with --gpu)')
+    parser_genpng.add_argument('--fftw-wisdom', help='File used to load and save pyFFTW wisdom across runs (optional)')
+    parser_genpng.add_argument('--format', choices=['png', 'npy'], default='png', help='Output file format (genpkl requires png)')
     parser_genpng.set_defaults(func=genpng)
 
     parser_genpkl = subparsers.add_parser('genpkl', help='PNG to PKL converter (used in training)')
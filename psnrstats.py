@@ -3,6 +3,15 @@ import matplotlib.pyplot as plt
 import re
 import sys
 
+# One "index: value1 value2 value3" record per line
+PSNR_LINE_RE = re.compile(rb'^[ \t]*(\d+):[ \t]+(\d+\.\d+)[ \t]+(\d+\.\d+)[ \t]+(\d+\.\d+)', re.MULTILINE)
+PSNR_DTYPE = np.dtype([
+    ('index', np.int64),
+    ('noisy', np.float64),
+    ('denoised_clamped', np.float64),
+    ('denoised_psnr', np.float64)
+])
+
 def parse_psnr_file(file_path):
     """
     Parse PSNR values from a file with format:
@@ -11,28 +20,18 @@ def parse_psnr_file(file_path):
     Returns:
         A dictionary of numpy arrays, one for each column of values
     """
+    # Scan the whole file with a single precompiled pattern; lines that do
+    # not match are skipped, as before.
+    with open(file_path, 'rb') as f:
+        records = np.fromregex(f, PSNR_LINE_RE, PSNR_DTYPE)
+    
     values = {
-        'noisy': [],
-        'denoised_clamped': [],
-        'denoised_psnr': []
+        'noisy': records['noisy'],
+        'denoised_clamped': records['denoised_clamped'],
+        'denoised_psnr': records['denoised_psnr']
     }
     
-    indices = []
-    
-    with open(file_path, 'r') as f:
-        for line in f:
-            # Extract values using regex
-            match = re.match(r'\s*(\d+):\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)', line)
-            if match:
-                idx, val1, val2, val3 = match.groups()
-                indices.append(int(idx))
-                values['noisy'].append(float(val1))
-                values['denoised_clamped'].append(float(val2))
-                values['denoised_psnr'].append(float(val3))
-    
-    # Convert to numpy arrays
-    for key in values:
-        values[key] = np.array(values[key])
+    indices = records['index']
     
     return values, indices
 
@@ -43,15 +42,18 @@ def calculate_statistics(values):
     stats = {}
     
     for key, data in values.items():
+        # min, q1, median, q3 and max from a single partition of the data.
+        # The input is not overwritten since it is plotted afterwards.
+        vmin, q1, median, q3, vmax = np.percentile(data, [0, 25, 50, 75, 100])
         stats[key] = {
             'mean': np.mean(data),
-            'median': np.median(data),
+            'median': median,
             'std': np.std(data),
-            'min': np.min(data),
-            'max': np.max(data),
-            'range': np.max(data) - np.min(data),
-            'q1': np.percentile(data, 25),
-            'q3': np.percentile(data, 75)
+            'min': vmin,
+            'max': vmax,
+            'range': vmax - vmin,
+            'q1': q1,
+            'q3': q3
         }
     
     return stats
@@ -81,12 +83,17 @@ def plot_histograms(values):
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
     
     titles = ['Noisy', 'Denoised Method 1', 'Denoised Method 2']
-    data_keys = ['noisy', 'denoised_1', 'denoised_2']
+    data_keys = ['noisy', 'denoised_clamped', 'denoised_psnr']
+    
+    # Reduce each column once, and share the bin edges so that the three
+    # histograms use the same x-axis
+    means = {key: values[key].mean() for key in data_keys}
+    bins = np.histogram_bin_edges(np.concatenate([values[key] for key in data_keys]), bins=10)
     
     for i, (title, key) in enumerate(zip(titles, data_keys)):
-        axes[i].hist(values[key], bins=10, alpha=0.7, color=f'C{i}')
-        axes[i].axvline(np.mean(values[key]), color='red', linestyle='dashed', linewidth=1)
-        axes[i].set_title(f'{title} (Mean: {np.mean(values[key]):.2f} dB)')
+        axes[i].hist(values[key], bins=bins, alpha=0.7, color=f'C{i}')
+        axes[i].axvline(means[key], color='red', linestyle='dashed', linewidth=1)
+        axes[i].set_title(f'{title} (Mean: {means[key]:.2f} dB)')
         axes[i].set_xlabel('PSNR (dB)')
         axes[i].set_ylabel('Frequency')
     
@@ -101,8 +108,8 @@ def plot_comparison(values, indices):
     plt.figure(figsize=(12, 6))
     
     plt.plot(indices, values['noisy'], 'o-', label='Noisy', alpha=0.7)
-    plt.plot(indices, values['denoised_1'], 's-', label='Clamped PSNR', alpha=0.7)
-    plt.plot(indices, values['denoised_2'], '^-', label='Denoised PSNR', alpha=0.7)
+    plt.plot(indices, values['denoised_clamped'], 's-', label='Clamped PSNR', alpha=0.7)
+    plt.plot(indices, values['denoised_psnr'], '^-', label='Denoised PSNR', alpha=0.7)
     
     plt.xlabel('Image Index')
     plt.ylabel('PSNR (dB)')